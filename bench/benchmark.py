@@ -0,0 +1,375 @@
+"""
+Treeshop orchestration benchmark
+
+Measures how much of a sample's wall time is Treeshop itself by running the process, fusion
+and one_docker tasks from fabfile.py against mock cluster machines.
+
+Each mock machine is a directory on this machine standing in for its /mnt. run() and sudo()
+execute locally with /mnt rewritten to that directory and make pointed at bench/stub.mk,
+whose targets emit the same output trees as the real pipelines without doing any work.
+put() and get() copy files. Every call also sleeps for the configured round trip latency
+and bandwidth so the results approximate a real cluster. With --transfer-mb the chunked
+transfers of large files run too, against the mock machine's directory instead of sftp.
+
+The time between stages recorded by fabfile._progress, less the time spent inside make, is
+the orchestration overhead of that stage. The preamble, from starting a task to a machine's
+first stage (putting the Makefile and reading the manifest), and fabfile._find_machines run
+against a mock docker-machine directory of the same number of hosts are timed too. Results for
+each task, manifest size and host count are written to a json file, and compared against a
+previous one with --baseline:
+
+    python bench/benchmark.py --samples 1,8,32 --hosts 1,4 --output bench.json
+    python bench/benchmark.py --samples 1,8,32 --hosts 1,4 --baseline bench.json
+
+Requires the same Fabric 1 virtualenv as fabfile.py.
+"""
+import os
+import sys
+import re
+import json
+import glob
+import time
+import shutil
+import argparse
+import datetime
+import tempfile
+import subprocess
+from collections import Counter
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fabric.api import env, execute, local  # NOQA
+from fabric.operations import _AttributeString  # NOQA
+from fabric.utils import abort  # NOQA
+import fabfile  # NOQA
+
+STUB_MAKEFILE = os.path.join(BENCH_DIR, "stub.mk")
+STUB_BIN = os.path.join(BENCH_DIR, "bin")
+
+# Round trips and seconds spent in make for the current host, reset in each forked worker
+calls = Counter()
+compute = [0.0]
+options = None
+
+
+def _mnt():
+    """ Directory standing in for /mnt on the current mock machine """
+    return os.path.join(options.workdir, "hosts", env.host, "mnt")
+
+
+def _network(size=0):
+    time.sleep(options.latency + size / (options.bandwidth_mb * 1024.0 * 1024))
+
+
+def mock_run(command, *args, **kwargs):
+    """ run() and sudo() on a mock machine """
+    calls["run"] += 1
+    _network()
+    if env.cwd:
+        command = "cd {} && {}".format(env.cwd, command)
+    command = command.replace("/mnt", _mnt())
+    command = re.sub(r"\bmake\b", "make -s -f {}".format(STUB_MAKEFILE), command)
+
+    start = time.time()
+    process = subprocess.Popen(
+        ["/bin/bash", "-c", command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        env=dict(os.environ, PATH="{}:{}".format(STUB_BIN, os.environ["PATH"]),
+                 STUB_KB=str(options.stub_kb), STUB_SECONDS=str(options.stub_seconds)))
+    # Paths in the output should look like they came from a real machine
+    output = process.communicate()[0].decode().rstrip().replace(_mnt(), "/mnt")
+    if "make -s -f" in command:
+        compute[0] += time.time() - start
+
+    result = _AttributeString(output)
+    result.return_code = process.returncode
+    result.failed = process.returncode != 0
+    result.succeeded = not result.failed
+    result.stderr = ""
+    if result.failed and not env.warn_only:
+        abort("run() received nonzero return code {} while executing '{}'\n{}".format(
+            process.returncode, command, output))
+    return result
+
+
+def mock_put(local_path, remote_path, *args, **kwargs):
+    """ put() to a mock machine """
+    calls["put"] += 1
+    remote_path = remote_path.replace("/mnt", _mnt())
+    if os.path.isdir(remote_path):
+        remote_path = os.path.join(remote_path, os.path.basename(local_path))
+    if os.path.isdir(local_path):
+        shutil.copytree(local_path, remote_path)
+    else:
+        _network(os.path.getsize(local_path))
+        shutil.copy(local_path, remote_path)
+    return [remote_path]
+
+
+def mock_get(remote_glob, local_dir, *args, **kwargs):
+    """ get() from a mock machine, recursing into directories like the real one """
+    calls["get"] += 1
+    _network()
+    matches = glob.glob(remote_glob.replace("/mnt", _mnt()))
+    if not matches:
+        if env.warn_only:
+            return []
+        abort("'{}' is not a valid remote path".format(remote_glob))
+
+    # Like the real get() a local path that isn't a directory is the file to write
+    if len(matches) == 1 and os.path.isfile(matches[0]) and not os.path.isdir(local_dir) \
+            and not local_dir.endswith("/"):
+        _network(os.path.getsize(matches[0]))
+        shutil.copy(matches[0], local_dir)
+        return [local_dir]
+
+    paths = []
+    for match in matches:
+        for directory, _, files in os.walk(match) if os.path.isdir(match) else \
+                [(os.path.dirname(match), [], [os.path.basename(match)])]:
+            dest = os.path.join(local_dir, os.path.relpath(directory, os.path.dirname(match)))
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+            for name in files:
+                _network(os.path.getsize(os.path.join(directory, name)))
+                shutil.copy(os.path.join(directory, name), dest)
+                paths.append(os.path.join(dest, name))
+    return paths
+
+
+def mock_local(command, *args, **kwargs):
+    """ local() runs for real as its cost is part of the orchestration """
+    calls["local"] += 1
+    return local(command, *args, **kwargs)
+
+
+def record_progress(sample_id, stage, **fields):
+    """ Wrap fabfile._progress to log when each stage starts along with round trips so far """
+    with open(os.path.join(options.workdir, "events", "{}.json".format(env.host)), "a") as f:
+        f.write(json.dumps({"time": time.time(), "sample_id": sample_id, "stage": stage,
+                            "compute": compute[0], "calls": dict(calls)}) + "\n")
+    progress(sample_id, stage, **fields)
+
+
+progress = fabfile._progress
+fabfile.run = mock_run
+fabfile.sudo = mock_run
+fabfile.put = mock_put
+fabfile.get = mock_get
+fabfile.local = mock_local
+fabfile._progress = record_progress
+fabfile._remote_files = lambda: fabfile._LocalFiles(os.path.dirname(_mnt()))
+
+
+def _setup_cluster(samples, hosts):
+    """ Fresh storage hierarchy, manifest and mock machines under options.workdir """
+    if os.path.exists(options.workdir):
+        shutil.rmtree(options.workdir)
+    os.makedirs(os.path.join(options.workdir, "events"))
+    sample_ids = ["BENCH{:05d}".format(i) for i in range(samples)]
+    for sample_id in sample_ids:
+        original = os.path.join(options.workdir, "base", "primary", "original", sample_id)
+        os.makedirs(original)
+        for read in ("R1", "R2"):
+            with open(os.path.join(original, "{}_{}.fastq.gz".format(sample_id, read)),
+                      "wb") as f:
+                f.write(os.urandom(options.fastq_kb * 1024))
+    with open(os.path.join(options.workdir, "manifest.tsv"), "w") as f:
+        f.write("\n".join(sample_ids) + "\n")
+
+    env.hosts = ["bench-{}".format(i) for i in range(hosts)]
+    env.hostnames = env.hosts
+    for index, host in enumerate(env.hosts):
+        os.makedirs(os.path.join(options.workdir, "hosts", host, "mnt", "samples"))
+        os.makedirs(os.path.join(options.workdir, "hosts", host, "mnt", "outputs"))
+        # What docker-machine would leave in ~/.docker for _find_machines to read
+        machine = os.path.join(options.workdir, "home", ".docker", "machine", "machines", host)
+        os.makedirs(machine)
+        with open(os.path.join(machine, "config.json"), "w") as f:
+            f.write(json.dumps({"Driver": {"MachineName": host,
+                                           "IPAddress": "10.0.{}.{}".format(*divmod(index, 256)),
+                                           "SSHKeyPath": "~/.ssh/id_rsa"}}))
+
+
+def _time_find_machines(repeat=5):
+    """ Median seconds fabfile._find_machines takes over the mock docker-machine directory """
+    home, hosts, hostnames = os.environ.get("HOME"), env.hosts, env.hostnames
+    os.environ["HOME"] = os.path.join(options.workdir, "home")
+    times = []
+    try:
+        for _ in range(repeat):
+            env.hosts = []
+            start = time.time()
+            fabfile._find_machines()
+            times.append(time.time() - start)
+    finally:
+        if home is None:
+            del os.environ["HOME"]
+        else:
+            os.environ["HOME"] = home
+        env.hosts, env.hostnames = hosts, hostnames
+    return sorted(times)[len(times) // 2]
+
+
+def _stats(values):
+    values = sorted(values)
+    return {"mean": sum(values) / len(values), "median": values[len(values) // 2],
+            "max": values[-1]} if values else {}
+
+
+def _round_trips(calls_after, calls_before):
+    return sum(calls_after.get(call, 0) - calls_before.get(call, 0)
+               for call in ("run", "put", "get"))
+
+
+def _summarize(events):
+    """ Orchestration seconds and round trips per stage and per sample from progress events """
+    stages = {}
+    samples = {}
+    for host_events in events:
+        for event, following in zip(host_events, host_events[1:]):
+            if event["stage"] in ("finished", "done"):
+                continue
+            seconds = following["time"] - event["time"] - (following["compute"] - event["compute"])
+            round_trips = _round_trips(following["calls"], event["calls"])
+            stage = stages.setdefault(event["stage"], {"seconds": [], "round_trips": []})
+            stage["seconds"].append(seconds)
+            stage["round_trips"].append(round_trips)
+            samples[event["sample_id"]] = samples.get(event["sample_id"], 0) + seconds
+
+    return ({name: {"seconds": _stats(stage["seconds"]),
+                    "round_trips": _stats(stage["round_trips"])}
+             for name, stage in stages.items()},
+            _stats(list(samples.values())))
+
+
+def _preamble(events, start, calls_before):
+    """ Seconds and round trips from starting the task to each machine's first progress event """
+    return {"seconds": _stats([host_events[0]["time"] - start
+                               for host_events in events if host_events]),
+            "round_trips": _stats([_round_trips(host_events[0]["calls"], calls_before)
+                                   for host_events in events if host_events])}
+
+
+def benchmark(task, samples, hosts):
+    """ Run one task over a fresh mock cluster and summarize its orchestration overhead """
+    _setup_cluster(samples, hosts)
+    find_machines = _time_find_machines()
+    cwd, stdout = os.getcwd(), sys.stdout
+    os.chdir(options.workdir)
+    sys.stdout = open(os.path.join(options.workdir, "log.txt"), "w")
+    calls_before = dict(calls)
+    start = time.time()
+    try:
+        execute(getattr(fabfile, task), hosts=env.hosts,
+                manifest=os.path.join(options.workdir, "manifest.tsv"),
+                base=os.path.join(options.workdir, "base"))
+    finally:
+        wall = time.time() - start
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+
+    events = []
+    for path in sorted(glob.glob(os.path.join(options.workdir, "events", "*.json"))):
+        with open(path) as f:
+            events.append([json.loads(line) for line in f])
+    stages, per_sample = _summarize(events)
+    return {"task": task, "samples": samples, "hosts": hosts, "wall": wall,
+            "per_sample": per_sample, "stages": stages, "find_machines": find_machines,
+            "preamble": _preamble(events, start, calls_before)}
+
+
+def compare(results, baseline, tolerance):
+    """ Print runs slower or with more round trips than the baseline, returning how many """
+    previous = {(run["task"], run["samples"], run["hosts"]): run for run in baseline["runs"]}
+    regressions = 0
+    for run in results["runs"]:
+        before = previous.get((run["task"], run["samples"], run["hosts"]))
+        if not before or not run["per_sample"] or not before["per_sample"]:
+            continue
+        label = "{} samples={} hosts={}".format(run["task"], run["samples"], run["hosts"])
+        change = run["per_sample"]["mean"] / max(before["per_sample"]["mean"], 1e-6) - 1
+        if change > tolerance:
+            regressions += 1
+            print("REGRESSION {} orchestration per sample {:.3f}s -> {:.3f}s ({:+.0%})".format(
+                label, before["per_sample"]["mean"], run["per_sample"]["mean"], change))
+        stages = dict(run["stages"], preamble=run["preamble"])
+        for name, stage in sorted(stages.items()):
+            old = dict(before["stages"], preamble=before.get("preamble")).get(name)
+            if old and stage["round_trips"]["mean"] > old["round_trips"]["mean"]:
+                regressions += 1
+                print("REGRESSION {} {} round trips {:.1f} -> {:.1f}".format(
+                    label, name, old["round_trips"]["mean"], stage["round_trips"]["mean"]))
+    return regressions
+
+
+def main():
+    global options
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tasks", default="process,fusion,one_docker",
+                        help="Comma separated fabfile tasks to benchmark")
+    parser.add_argument("--samples", default="1,8,32",
+                        help="Comma separated manifest sizes")
+    parser.add_argument("--hosts", default="1,4", help="Comma separated cluster sizes")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds per simulated ssh round trip")
+    parser.add_argument("--bandwidth-mb", type=float, default=100,
+                        help="Simulated put/get bandwidth in MB/s")
+    parser.add_argument("--fastq-kb", type=int, default=256, help="Size of each input fastq")
+    parser.add_argument("--stub-kb", type=int, default=64, help="Size of each output file")
+    parser.add_argument("--stub-seconds", type=float, default=0,
+                        help="Seconds each stub make target sleeps")
+    parser.add_argument("--transfer-mb", type=float,
+                        help="Use chunked transfers of this chunk size for files this large or "
+                             "more instead of put/get, e.g. 0.1 to exercise them on small files")
+    parser.add_argument("--output", default="bench-results.json",
+                        help="Where to write the results json")
+    parser.add_argument("--baseline", help="Previous results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fractional slowdown per sample reported as a regression")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(),
+                                                          "treeshop-bench"),
+                        help="Scratch directory for the storage hierarchy and mock machines")
+    options = parser.parse_args()
+
+    os.environ.setdefault("USER", "bench")
+    env.real_fabfile = fabfile.__file__
+    if options.transfer_mb:
+        env.transfer_threshold_mb = options.transfer_mb
+        env.transfer_chunk_mb = options.transfer_mb
+
+    results = {
+        "treeshop_version": local("git --work-tree={0} --git-dir {0}/.git describe --always --dirty"
+                                  .format(os.path.dirname(BENCH_DIR)), capture=True),
+        "date": datetime.datetime.utcnow().isoformat(),
+        "options": {k: v for k, v in vars(options).items()
+                    if k not in ("output", "baseline", "workdir")},
+        "runs": []}
+
+    print("{:<12} {:>8} {:>6} {:>9} {:>14} {:>12} {:>10} {:>10}".format(
+        "TASK", "SAMPLES", "HOSTS", "WALL", "OVERHEAD/SMPL", "TRIPS/SMPL", "PREAMBLE",
+        "MACHINES"))
+    for task in options.tasks.split(","):
+        for samples in [int(n) for n in options.samples.split(",")]:
+            for hosts in [int(n) for n in options.hosts.split(",")]:
+                run = benchmark(task, samples, hosts)
+                results["runs"].append(run)
+                print(("{:<12} {:>8} {:>6} {:>8.2f}s {:>13.3f}s {:>12.1f} {:>9.3f}s "
+                       "{:>9.4f}s").format(
+                    task, samples, hosts, run["wall"], run["per_sample"].get("mean", 0),
+                    sum(stage["round_trips"]["mean"] for stage in run["stages"].values()),
+                    run["preamble"]["seconds"].get("max", 0), run["find_machines"]))
+
+    with open(options.output, "w") as f:
+        f.write(json.dumps(results, indent=4, sort_keys=True))
+    print("Results written to {}".format(options.output))
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            if compare(results, json.load(f), options.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Stand-in for the pipelines Makefile used by bench/benchmark.py
+#
+# Each target writes the same output tree as the real pipeline docker would, filled with
+# STUB_KB of random bytes per data file, after sleeping STUB_SECONDS. This way only the
+# Treeshop orchestration around each make call is measured.
+
+STUB_SECONDS ?= 0
+STUB_KB ?= 64
+
+SAMPLE = stub_R1merged
+BLOB = head -c $(STUB_KB)K /dev/urandom >
+
+checksums:
+	sleep $(STUB_SECONDS)
+	mkdir -p outputs/checksums
+	cd samples && md5sum * > ../outputs/checksums/md5
+
+expression:
+	sleep $(STUB_SECONDS)
+	mkdir -p outputs/expression/stub/$(SAMPLE)/RSEM/Hugo \
+		outputs/expression/stub/$(SAMPLE)/Kallisto \
+		outputs/expression/stub/$(SAMPLE)/QC/fastQC \
+		outputs/expression/stub/$(SAMPLE)/QC/STAR
+	cd outputs/expression/stub/$(SAMPLE) && \
+		$(BLOB) RSEM/rsem_genes.results && \
+		$(BLOB) RSEM/rsem_isoforms.results && \
+		$(BLOB) RSEM/Hugo/rsem_genes.hugo.results && \
+		$(BLOB) RSEM/Hugo/rsem_isoforms.hugo.results && \
+		$(BLOB) Kallisto/abundance.h5 && \
+		$(BLOB) Kallisto/abundance.tsv && \
+		$(BLOB) Kallisto/fusion.txt && \
+		echo '{}' > Kallisto/run_info.json && \
+		$(BLOB) QC/fastQC/R1_fastqc.html && \
+		$(BLOB) QC/fastQC/R1_fastqc.zip && \
+		$(BLOB) QC/fastQC/R2_fastqc.html && \
+		$(BLOB) QC/fastQC/R2_fastqc.zip && \
+		$(BLOB) QC/STAR/Log.final.out && \
+		$(BLOB) QC/STAR/SJ.out.tab && \
+		$(BLOB) $(SAMPLE).sorted.bam
+	tar -czf outputs/expression/$(SAMPLE).tar.gz -C outputs/expression/stub $(SAMPLE)
+	rm -rf outputs/expression/stub
+
+expression_ercc: expression
+
+qc:
+	sleep $(STUB_SECONDS)
+	test -f outputs/expression/*.bam
+	mkdir -p outputs/qc
+	cd outputs/qc && \
+		echo '{}' > bam_umend_qc.json && \
+		$(BLOB) bam_umend_qc.tsv && \
+		$(BLOB) readDist.txt && \
+		$(BLOB) sortedByCoord.md.bam && \
+		$(BLOB) sortedByCoord.md.bam.bai
+
+qc_ercc: qc
+
+pizzly:
+	sleep $(STUB_SECONDS)
+	test -f outputs/expression/Kallisto/fusion.txt
+	mkdir -p outputs/pizzly
+	$(BLOB) outputs/pizzly/pizzly-fusion.final
+
+fusions:
+	sleep $(STUB_SECONDS)
+	mkdir -p outputs/fusions
+	cd outputs/fusions && \
+		$(BLOB) Log.final.out && \
+		$(BLOB) star-fusion-gene-list-filtered.final && \
+		$(BLOB) star-fusion-non-filtered.final && \
+		$(BLOB) FusionInspector.junction_reads.bam && \
+		$(BLOB) FusionInspector.spanning_reads.bam
+
+variants:
+	sleep $(STUB_SECONDS)
+	test -f outputs/qc/sortedByCoord.md.bam
+	mkdir -p outputs/variants
+	$(BLOB) outputs/variants/mini.ann.vcf
+
+jfkm:
+	sleep $(STUB_SECONDS)
+	mkdir -p outputs/jfkm
+	cd outputs/jfkm && \
+		$(BLOB) counts.jf && \
+		$(BLOB) FLT3-ITD.mut && \
+		$(BLOB) FLT3-ITD.report && \
+		$(BLOB) jfkm.log
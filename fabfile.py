@@ -33,11 +33,20 @@ NOTE: See Makefile for regex that looks from right for 1 or 2 to find pairs
 """
 import os
 import datetime
+import time
 import json
 import glob
 import re
-from fabric.api import env, local, run, sudo, runs_once, parallel, warn_only, cd, settings
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+from paramiko import SSHException
+from fabric.api import (env, local, run, sudo, runs_once, parallel, warn_only, cd, settings,
+                        execute, hide, abort)
 from fabric.operations import put, get
+from fabric.state import connections
+from fabric.network import connect, normalize
+from fabric.exceptions import NetworkError
 
 # To debug communication issues un-comment the following
 # import logging
@@ -72,6 +81,83 @@ def _log_error(message):
     with open("errors.txt", "a") as error_log:
         error_log.write(message + "\n")
 
+
+"""
+Each worker records the sample and stage it is working on in progress/<host>.json and appends
+the duration of every completed stage to progress/<host>.history. The status task merges these
+with a concurrent poll of the machines so we don't have to ssh in to see where things are.
+"""
+
+PROGRESS_DIR = "progress"
+
+
+def _progress_path(host, extension="json"):
+    return os.path.join(PROGRESS_DIR, "{}.{}".format(host, extension))
+
+
+def _read_progress(host):
+    try:
+        with open(_progress_path(host)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _progress(sample_id, stage, **fields):
+    """ Record that this host has moved on to 'stage' of 'sample_id'
+
+        The previous stage is added to the history only if it belongs to the same sample
+        so that failed stages (where we skip to the next sample) don't skew the medians.
+    """
+    now = time.time()
+    if not os.path.exists(PROGRESS_DIR):
+        os.makedirs(PROGRESS_DIR)
+    state = _read_progress(env.host)
+    if state.get("sample_id") == sample_id and state.get("stage_start"):
+        with open(_progress_path(env.host, "history"), "a") as f:
+            f.write(json.dumps({"sample_id": sample_id, "stage": state["stage"],
+                                "seconds": now - state["stage_start"]}) + "\n")
+    else:
+        state["sample_start"] = now
+    state.update(fields)
+    state.update({"host": env.host, "sample_id": sample_id, "stage": stage,
+                  "stage_start": now})
+
+    # Write and rename so status never sees a partial file
+    with open(_progress_path(env.host, "tmp"), "w") as f:
+        f.write(json.dumps(state, indent=4))
+    os.rename(_progress_path(env.host, "tmp"), _progress_path(env.host))
+
+
+def _stage_medians():
+    """ Median seconds per stage across the history of all hosts """
+    durations = {}
+    for path in glob.glob(os.path.join(PROGRESS_DIR, "*.history")):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                durations.setdefault(entry["stage"], []).append(entry["seconds"])
+    medians = {}
+    for stage, seconds in durations.items():
+        seconds = sorted(seconds)
+        middle = len(seconds) // 2
+        medians[stage] = seconds[middle] if len(seconds) % 2 else \
+            (seconds[middle - 1] + seconds[middle]) / 2.0
+    return medians
+
+
+def _duration(seconds):
+    """ Format seconds as 3h05m or 4m12s """
+    if seconds is None:
+        return "-"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "{}h{:02d}m".format(seconds // 3600, seconds % 3600 // 60)
+    return "{}m{:02d}s".format(seconds // 60, seconds % 60)
+
 @runs_once
 def up(count=1):
     """ Spin up 'count' docker machines """
@@ -132,6 +218,81 @@ def top():
     run("docker ps")
 
 
+@parallel
+def _poll():
+    """ Running containers and /mnt usage for a single machine in one round trip """
+    with settings(warn_only=True):
+        result = run("docker ps --format '{{.Names}}'; echo ---; df -P /mnt | tail -1")
+    if result.failed:
+        return None
+    containers, _, df = result.stdout.partition("---")
+    fields = df.split()
+    if len(fields) < 5:
+        return {"containers": containers.split(), "mnt": "-"}
+    return {"containers": containers.split(),
+            "mnt": "{} used {:.0f}G free".format(fields[4], int(fields[3]) / 1024.0 / 1024)}
+
+
+@runs_once
+def status(watch=0, pool=50, straggler=1.5):
+    """ Table of each machine's sample, stage and elapsed vs. median time
+
+        Polls all machines concurrently, up to 'pool' at a time. Pass watch=seconds to refresh
+        continuously. Stages running more than 'straggler' times their median are listed
+        separately.
+    """
+    names = dict(zip(env.hosts, env.hostnames))
+    while True:
+        start = time.time()
+        with settings(hide("everything", "aborts"), pool_size=int(pool), timeout=5, connection_attempts=1,
+                      skip_bad_hosts=True, abort_on_prompts=True, warn_only=True):
+            polls = execute(_poll, hosts=env.hosts)
+        medians = _stage_medians()
+        now = time.time()
+
+        rows = [("MACHINE", "SAMPLE", "QUEUE", "STAGE", "ELAPSED", "MEDIAN", "SAMPLE TOTAL",
+                 "/mnt", "DOCKERS")]
+        stragglers = []
+        for host in env.hosts:
+            state = _read_progress(host)
+            # Failed polls come back as the exception raised in that host's process
+            poll = polls.get(host) if isinstance(polls.get(host), dict) else None
+            stage = state.get("stage", "-")
+            elapsed = now - state["stage_start"] if "stage_start" in state else None
+            median = medians.get(stage)
+            rows.append((
+                names.get(host, host),
+                state.get("sample_id") or "-",
+                "{}/{}".format(state["position"], state["total"]) if "total" in state else "-",
+                stage,
+                _duration(elapsed),
+                _duration(median),
+                _duration(now - state["sample_start"]) if "sample_start" in state else "-",
+                poll["mnt"] if poll else "unreachable",
+                ",".join(poll["containers"]) if poll else "-"))
+            if elapsed and median and stage not in ("finished", "done") \
+                    and elapsed > float(straggler) * median:
+                stragglers.append((names.get(host, host), state.get("sample_id"), stage,
+                                   elapsed / median))
+
+        if int(watch):
+            print("\033[2J\033[H")
+        print("{:%Y-%m-%d %H:%M:%S} polled {} machines in {:.1f}s".format(
+            datetime.datetime.now(), len(env.hosts), now - start))
+        widths = [max(len(str(row[i])) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)).rstrip())
+
+        if stragglers:
+            print("\nStragglers (more than {}x median):".format(straggler))
+            for name, sample_id, stage, ratio in sorted(stragglers, key=lambda s: -s[3]):
+                print("  {} {} {} {:.1f}x".format(name, sample_id, stage, ratio))
+
+        if not int(watch):
+            break
+        time.sleep(int(watch))
+
+
 
 @parallel
 def installdocker():
@@ -206,18 +367,328 @@ def reset():
         sudo("chown -R ubuntu:ubuntu /mnt")
 
 
-def _put_primary(sample_id, base):
-    """ Search all fastqs and bams, convert and put to machine as needed """
+"""
+Large fastqs and bams are transferred in chunks over several concurrent SSH connections. Each chunk
+is hashed on both ends and recorded in .name.part.chunks next to the .name.part data file so an
+interrupted transfer picks up from the last verified chunk. The .part file is only renamed to its
+real name once every chunk is verified, so partial bams never show up in primary/derived.
+
+Tune with fab --set transfer_chunk_mb=256,transfer_channels=4,transfer_threshold_mb=512
+"""
+
+TRANSFER_RETRIES = 5
+TRANSFER_BLOCK = 1024 * 1024
+
+
+def _transfer_settings():
+    """ Chunk size, number of channels, and the size below which plain put/get is used """
+    return (int(float(env.get("transfer_chunk_mb", 256)) * 1024 * 1024),
+            int(env.get("transfer_channels", 4)),
+            int(float(env.get("transfer_threshold_mb", 512)) * 1024 * 1024))
+
+
+class _LocalFiles(object):
+    """ Chunk level file access on this machine
+
+        With a 'root' this stands in for a remote machine with its / under root, which lets the
+        transfer code be exercised without an ssh server.
+    """
+
+    def __init__(self, root=""):
+        self.root = root
+
+    def _path(self, path):
+        return self.root + path
+
+    def size(self, path):
+        try:
+            return os.path.getsize(self._path(path))
+        except OSError:
+            return None
+
+    def mtime(self, path):
+        return int(os.path.getmtime(self._path(path)))
+
+    def read(self, path):
+        try:
+            with open(self._path(path)) as f:
+                return f.read()
+        except IOError:
+            return ""
+
+    def write(self, path, text, mode="w"):
+        with open(self._path(path), mode) as f:
+            f.write(text)
+
+    def create(self, path, size):
+        with open(self._path(path), "wb") as f:
+            f.truncate(size)
+
+    def read_range(self, path, offset, length):
+        with open(self._path(path), "rb") as f:
+            f.seek(offset)
+            while length > 0:
+                block = f.read(min(TRANSFER_BLOCK, length))
+                if not block:
+                    raise IOError("{} is shorter than expected".format(path))
+                length -= len(block)
+                yield block
+
+    def write_range(self, path, offset, blocks):
+        with open(self._path(path), "r+b") as f:
+            f.seek(offset)
+            for block in blocks:
+                f.write(block)
+            os.fsync(f.fileno())
+
+    def md5(self, path, offset, length):
+        digest = hashlib.md5()
+        for block in self.read_range(path, offset, length):
+            digest.update(block)
+        return digest.hexdigest()
+
+    def rename(self, source, dest):
+        os.rename(self._path(source), self._path(dest))
+
+    def remove(self, path):
+        os.remove(self._path(path))
+
+    def reconnect(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _SftpFiles(object):
+    """ Chunk level file access on a cluster machine with an SSH connection per thread
+
+        Separate connections rather than channels on fabric's give each thread its own TCP
+        stream, and keep the sessions open on any one connection, its sftp and an md5, well
+        under sshd's default MaxSessions of 10.
+    """
+
+    def __init__(self, host_string):
+        self.host_string = host_string
+        self.threads = threading.local()
+        self.lock = threading.Lock()
+        self.clients = []
+        # Connect up front in the calling thread in case fabric needs to prompt
+        connections[host_string]
+
+    def _client(self):
+        if getattr(self.threads, "client", None) is None:
+            user, host, port = normalize(self.host_string)
+            client = connect(user, host, port, connections)
+            with self.lock:
+                self.clients.append(client)
+            self.threads.sftp = client.open_sftp()
+            self.threads.client = client
+        return self.threads.client
+
+    def _sftp(self):
+        self._client()
+        return self.threads.sftp
+
+    def size(self, path):
+        try:
+            return self._sftp().stat(path).st_size
+        except IOError:
+            return None
+
+    def mtime(self, path):
+        return int(self._sftp().stat(path).st_mtime)
+
+    def read(self, path):
+        try:
+            with self._sftp().open(path) as f:
+                return f.read().decode()
+        except IOError:
+            return ""
+
+    def write(self, path, text, mode="w"):
+        with self._sftp().open(path, mode) as f:
+            f.write(text)
+
+    def create(self, path, size):
+        with self._sftp().open(path, "wb") as f:
+            f.truncate(size)
+
+    def read_range(self, path, offset, length):
+        with self._sftp().open(path, "rb") as f:
+            # readv pipelines the requests instead of one round trip per 32k read
+            for block in f.readv([(start, min(TRANSFER_BLOCK, offset + length - start))
+                                  for start in range(offset, offset + length, TRANSFER_BLOCK)]):
+                yield block
+
+    def write_range(self, path, offset, blocks):
+        with self._sftp().open(path, "r+b") as f:
+            f.set_pipelined(True)
+            f.seek(offset)
+            for block in blocks:
+                f.write(block)
+
+    def md5(self, path, offset, length):
+        stdin, stdout, stderr = self._client().exec_command(
+            "dd if={} bs=4M skip={} count={} iflag=skip_bytes,count_bytes 2>/dev/null "
+            "| md5sum".format(path, offset, length))
+        return stdout.read().decode().split()[0]
+
+    def rename(self, source, dest):
+        self._sftp().posix_rename(source, dest)
+
+    def remove(self, path):
+        self._sftp().remove(path)
+
+    def reconnect(self):
+        # Drop this thread's connection, the next call opens a fresh one
+        client, self.threads.client = getattr(self.threads, "client", None), None
+        if client is not None:
+            client.close()
+
+    def close(self):
+        with self.lock:
+            for client in self.clients:
+                client.close()
+            self.clients = []
+
+
+def _remote_files():
+    """ File access for the current host, swapped for a _LocalFiles stand-in by the benchmark """
+    return _SftpFiles(env.host_string)
+
+
+def _transfer(source, source_path, dest, dest_path):
+    """ Copy source_path to dest_path in verified chunks over parallel connections
+
+        Resumes from a previous attempt if its chunk record matches the source size, modification
+        time and chunk size. Returns dest_path once it has been atomically renamed into place.
+    """
+    chunk_size, channels, _ = _transfer_settings()
+    size = source.size(source_path)
+    if size is None:
+        raise IOError("Unable to find {} to transfer".format(source_path))
+    directory, name = dest_path.rsplit("/", 1)
+    part = "{}/.{}.part".format(directory, name)
+    record = "{}.chunks".format(part)
+
+    # The mtime ties the chunks to this version of the source, e.g. not a re-generated bam
+    header = "{} {} {}".format(size, source.mtime(source_path), chunk_size)
+    lines = dest.read(record).splitlines()
+    if lines[:1] == [header] and dest.size(part) == size:
+        verified = set(int(line.split()[0]) for line in lines[1:] if line.strip())
+        print("Resuming {} with {} chunks already verified".format(name, len(verified)))
+    else:
+        dest.create(part, size)
+        dest.write(record, header + "\n")
+        verified = set()
+
+    chunks = [(index, offset, min(chunk_size, size - offset))
+              for index, offset in enumerate(range(0, size, chunk_size)) if index not in verified]
+
+    def copy(chunk):
+        index, offset, length = chunk
+        for attempt in range(TRANSFER_RETRIES):
+            try:
+                dest.write_range(part, offset, source.read_range(source_path, offset, length))
+                # Hash the source where it lives so a get is checked against the file on the
+                # machine rather than the bytes as they arrived
+                digest = source.md5(source_path, offset, length)
+                if dest.md5(part, offset, length) == digest:
+                    return index, digest
+                print("Chunk {} of {} failed verification, retrying".format(index, name))
+            except (EnvironmentError, EOFError, SSHException, NetworkError) as e:
+                print("Chunk {} of {} failed ({}), reconnecting".format(index, name, e))
+                time.sleep(2 ** attempt)
+                source.reconnect()
+                dest.reconnect()
+        raise IOError("Unable to transfer chunk {} of {}".format(index, source_path))
+
+    pool = ThreadPool(channels)
+    try:
+        for index, md5 in pool.imap_unordered(copy, chunks):
+            dest.write(record, "{} {}\n".format(index, md5), mode="a")
+    finally:
+        pool.terminate()
+        pool.join()
+        source.close()
+        dest.close()
+
+    dest.rename(part, dest_path)
+    dest.remove(record)
+    return dest_path
+
+
+def _put_large(path, remote_dir):
+    """ put() that switches to a resumable chunked transfer for large files """
+    if os.path.getsize(path) < _transfer_settings()[2]:
+        return put(path, remote_dir)
+    print("[{}] chunked put: {} -> {}".format(env.host_string, path, remote_dir))
+    return [_transfer(_LocalFiles(), os.path.abspath(path), _remote_files(),
+                      "{}/{}".format(remote_dir.rstrip("/"), os.path.basename(path)))]
+
+
+def _get_large(remote_glob, local_dir):
+    """ get() that switches to a resumable chunked transfer for large files """
+    with settings(hide("running", "stdout"), warn_only=True):
+        result = run("stat -c '%s %n' {}".format(remote_glob))
+    if result.failed:
+        # Nothing matched so let get() fail or warn as it normally would
+        return get(remote_glob, local_dir)
+
+    paths = []
+    for line in result.splitlines():
+        size, path = line.strip().split(" ", 1)
+        if int(size) < _transfer_settings()[2]:
+            # Get to a hidden name and rename so a dropped connection can't leave a partial file
+            name = os.path.basename(path)
+            part = os.path.join(local_dir, ".{}.part".format(name))
+            get(path, part)
+            os.rename(part, os.path.join(local_dir, name))
+            paths.append(os.path.join(local_dir, name))
+        else:
+            print("[{}] chunked get: {} -> {}".format(env.host_string, path, local_dir))
+            paths.append(_transfer(_remote_files(), path, _LocalFiles(), os.path.join(
+                os.path.abspath(local_dir), os.path.basename(path))))
+    return paths
+
+
+def _put_samples(files, keep=()):
+    """ Copy files to /mnt/samples, dropping partial uploads left over from other samples
+
+        Partial uploads are hidden dot files so they survive reset() and can be resumed. Those
+        of 'keep', files this sample puts afterwards, are left to be resumed too.
+    """
+    run("find /mnt/samples -maxdepth 1 -name '.*.part*' {} -delete".format(
+        " ".join("! -name '.{}.part*'".format(os.path.basename(f))
+                 for f in list(files) + list(keep))))
+    for path in files:
+        print("Copying {} to cluster machine....".format(path))
+        _put_large(path, "/mnt/samples/")
+
+
+def _primary_files(sample_id, base, inputs=None):
+    """ Find the secondary input files for a sample, or use 'inputs' (relative to base) if given
+
+        Returns how they need to be put to the machine, one of 'derived', 'primary',
+        'concatenate' or 'bam', along with the files, or (None, []) if there are none usable.
+    """
+    if inputs:
+        files = sorted(os.path.join(base, path) for path in inputs)
+        fastqs = [f for f in files if re.search(r"\.(fastq|fq|txt)\.gz$", f)]
+        if len(fastqs) == len(files) == 2:
+            return "primary", files
+        if len(fastqs) == len(files) and len(files) > 2 and len(files) % 2 == 0:
+            return "concatenate", files
+        if len(files) == 1 and files[0].endswith(".bam"):
+            return "bam", files
+        return None, []
 
     # First see if there are ONLY two fastqs in derived
     files = sorted(glob.glob("{}/primary/derived/{}/*.fastq.gz".format(base, sample_id))
                    + glob.glob("{}/primary/derived/{}/*.fq.gz".format(base, sample_id)))
     if len(files) == 2:
-        print("Processing two derived fastqs for {}".format(sample_id))
-        for fastq in files:
-            print("Copying fastq {} to cluster machine....".format(fastq))
-            put(fastq, "/mnt/samples/")
-        return files
+        return "derived", files
 
     # Look for fastqs in primary
     files = sorted(glob.glob("{}/primary/original/{}/*.txt.gz".format(base, sample_id))
@@ -226,18 +697,32 @@ def _put_primary(sample_id, base):
 
     # Two primary fastqs
     if len(files) == 2:
-        print("Processing two primary fastqs for {}".format(sample_id))
-        for fastq in files:
-            print("Copying fastq {} to cluster machine....".format(fastq))
-            put(fastq, "/mnt/samples/")
-        return files
+        return "primary", files
 
     # More then two original fastqs so concatenate
     if len(files) > 2 and len(files) % 2 == 0:
+        return "concatenate", files
+
+    # No fastqs so look for a single bam in original
+    files = sorted(glob.glob("{}/primary/original/{}/*.bam".format(base, sample_id)))
+    if len(files) == 1:
+        return "bam", files
+
+    return None, []
+
+
+def _put_primary(sample_id, base, inputs=None):
+    """ Search all fastqs and bams, convert and put to machine as needed """
+    kind, files = _primary_files(sample_id, base, inputs)
+
+    if kind in ("derived", "primary"):
+        print("Processing two {} fastqs for {}".format(kind, sample_id))
+        _put_samples(files)
+        return files
+
+    if kind == "concatenate":
         print("Converting multiple primary fastqs for {}".format(sample_id))
-        for fastq in files:
-            print("Copying fastq {} to cluster machine....".format(fastq))
-            put(fastq, "/mnt/samples/")
+        _put_samples(files)
         names = [os.path.basename(f) for f in files]
         print("Names:", names)
         print("Concatenating fastqs...")
@@ -247,12 +732,10 @@ def _put_primary(sample_id, base):
             run("rm {}".format(" ".join(names)))  # Free up space
         return files
 
-    # No fastqs so look for a single bam in original
-    files = sorted(glob.glob("{}/primary/original/{}/*.bam".format(base, sample_id)))
-    if len(files) == 1:
+    if kind == "bam":
         print("Converting original bam for {}".format(sample_id))
         bam = os.path.basename(files[0])
-        put(files[0], "/mnt/samples/")
+        _put_samples(files)
         with cd("/mnt/samples"):
             run("docker run --rm"
                 " -v /mnt/samples:/data"
@@ -263,15 +746,49 @@ def _put_primary(sample_id, base):
         local("mkdir -p {}/primary/derived/{}".format(base, sample_id))
         print("Copying fastqs back for archiving")
         get("/mnt/samples/*.log", "{}/primary/derived/{}/".format(base, sample_id))
-        fastqs = get("/mnt/samples/*.fastq.gz", "{}/primary/derived/{}/".format(base, sample_id))
+        fastqs = _get_large("/mnt/samples/*.fastq.gz", "{}/primary/derived/{}/".format(base, sample_id))
         return fastqs
 
     print("ERROR Unable to find or derive secondary input for {}".format(sample_id))
     return []
 
 
+# Output directories and pipelines of expression and qc, shared with _checkpoint which has to
+# recognize what they wrote
+EXPRESSION_DIR = "ucsc_cgl-rnaseq-cgl-pipeline-3.3.4-785eee9"
+EXPRESSION_ERCC_DIR = "ucsc_cgl-rnaseq-cgl-pipeline-ERCC-3.3.4-785eee9"
+QC_DIR = "ucsctreehouse-bam-umend-qc-1.1.1-5f286d7"
+QC_ERCC_DIR = "ucsctreehouse-bam-mend-qc-ERCC-v2.0.2-1c3c627"
+
+EXPRESSION_PIPELINE = {
+    "source": "https://github.com/BD2KGenomics/toil-rnaseq",
+    "docker": {
+        "url": "https://quay.io/ucsc_cgl/rnaseq-cgl-pipeline",
+        "version": "3.3.4-1.12.3",
+        "hash": "sha256:785eee9f750ab91078d84d1ee779b6f74717eafc09e49da817af6b87619b0756" # NOQA
+    }
+}
+QC_PIPELINE = {
+    "source": "https://github.com/UCSC-Treehouse/bam-umend-qc",
+    "docker": {
+        "url": "https://hub.docker.com/r/ucsctreehouse/bam-umend-qc",
+        "version": "1.1.1",
+        "hash": "sha256:5f286d72395fcc5085a96d463ae3511554acfa4951aef7d691bba2181596c31f" # NOQA
+    }
+}
+QC_ERCC_PIPELINE = {
+    "source": "https://github.com/UCSC-Treehouse/mend_qc/releases/tag/v2.0.2",
+    "docker": {
+        "url": "https://hub.docker.com/r/ucsctreehouse/bam-mend-qc/",
+        "version": "v2.0.2",
+        "hash": "sha256:1c3c62731eb7e6bbfcba4600807022e250a9ee5874477d115939a5d33f39e39f" # NOQA
+    }
+}
+
+
 def _fusions(base, output, methods, sample_id, fastqs, ercc=False):
     """Calculate fusion from fastq files"""
+    _progress(sample_id, "fusions")
     methods["start"] = datetime.datetime.utcnow().isoformat()
     with settings(warn_only=True):
         result = run("cd /mnt && make fusions")
@@ -325,13 +842,13 @@ def _fusions(base, output, methods, sample_id, fastqs, ercc=False):
     if bamdest:
         if ercc: # copy the bams over then rename back to original
             methods["outputs"] += [
-                os.path.relpath(p, base) for p in get("/mnt/outputs/FusionInspector.ERCC.*_reads.bam", bamdest)]
+                os.path.relpath(p, base) for p in _get_large("/mnt/outputs/FusionInspector.ERCC.*_reads.bam", bamdest)]
             with cd("/mnt/outputs"):
                 run("mv -v FusionInspector.ERCC.junction_reads.bam FusionInspector.junction_reads.bam")
                 run("mv -v FusionInspector.ERCC.spanning_reads.bam FusionInspector.spanning_reads.bam")
         else:
             methods["outputs"] += [
-                os.path.relpath(p, base) for p in get("/mnt/outputs/FusionInspector.*_reads.bam", bamdest)]
+                os.path.relpath(p, base) for p in _get_large("/mnt/outputs/FusionInspector.*_reads.bam", bamdest)]
     methods["end"] = datetime.datetime.utcnow().isoformat()
     methods["pipeline"] = {
         "source": "https://github.com/UCSC-Treehouse/fusion",
@@ -355,6 +872,7 @@ def _fusions(base, output, methods, sample_id, fastqs, ercc=False):
 def _jfkm(base, output, methods, sample_id, fastqs, ercc=False):
     """Calculate jfkm"""
     # ERCC - folder name change but nothing else
+    _progress(sample_id, "jfkm")
     methods["start"] = datetime.datetime.utcnow().isoformat()
     with settings(warn_only=True):
         result = run("cd /mnt && make jfkm")
@@ -394,6 +912,7 @@ def _pizzly(base, output, methods, sample_id, ercc=False):
     Run the Pizzly docker on a single sample and backhaul pizzly-fusion.final
     Expects that expression Kallisto output is available in pwd/outputs/expression/Kallisto
     """
+    _progress(sample_id, "pizzly")
     methods["start"] = datetime.datetime.utcnow().isoformat()
     with settings(warn_only=True):
         result = run("cd /mnt && make pizzly")
@@ -404,12 +923,10 @@ def _pizzly(base, output, methods, sample_id, ercc=False):
     # Update methods.json and copy pizzly-fusion.final file back
     if ercc:
         dest = "{}/pizzly-ERCC-0.37.3-43efb2f".format(output)
-        kallisto_dest = "{}/ucsc_cgl-rnaseq-cgl-pipeline-ERCC-3.3.4-785eee9/Kallisto".format(
-            os.path.relpath(output, base))
+        kallisto_dest = "{}/{}/Kallisto".format(os.path.relpath(output, base), EXPRESSION_ERCC_DIR)
     else:
         dest = "{}/pizzly-0.37.3-43efb2f".format(output)
-        kallisto_dest = "{}/ucsc_cgl-rnaseq-cgl-pipeline-3.3.4-785eee9/Kallisto".format(
-            os.path.relpath(output, base))
+        kallisto_dest = "{}/{}/Kallisto".format(os.path.relpath(output, base), EXPRESSION_DIR)
 
     local("mkdir -p {}".format(dest))
     methods["inputs"] = ["{}/abundance.h5".format(kallisto_dest),
@@ -429,18 +946,441 @@ def _pizzly(base, output, methods, sample_id, ercc=False):
         f.write(json.dumps(methods, indent=4))
     return True
 
+def _checksums(base, output, methods, sample_id, fastqs, ercc=False):
+    """Calculate md5 of the input fastqs"""
+    _progress(sample_id, "checksums")
+    methods["start"] = datetime.datetime.utcnow().isoformat()
+    with settings(warn_only=True):
+        result = run("cd /mnt && make checksums")
+        if result.failed:
+            _log_error("{} Failed checksums: {}".format(sample_id, result))
+            return False
+
+    # Update methods.json and copy output back
+    if ercc:
+        dest = "{}/md5sum-ERCC-3.7.0-ccba511".format(output)
+    else:
+        dest = "{}/md5sum-3.7.0-ccba511".format(output)
+    local("mkdir -p {}".format(dest))
+    methods["inputs"] = fastqs
+    methods["outputs"] = [
+        os.path.relpath(p, base) for p in get("/mnt/outputs/checksums/*", dest)]
+    methods["end"] = datetime.datetime.utcnow().isoformat()
+    methods["pipeline"] = {
+        "source": "https://github.com/gliderlabs/docker-alpine",
+        "docker": {
+            "url": "https://hub.docker.com/alpine",
+            "version": "3.7.0",
+            "hash": "sha256:ccba511b1d6b5f1d83825a94f9d5b05528db456d9cf14a1ea1db892c939cda64" # NOQA
+        }
+    }
+    with open("{}/methods.json".format(dest), "w") as f:
+        f.write(json.dumps(methods, indent=4))
+    return True
+
+
+def _expression(base, output, methods, sample_id, fastqs, ercc=False):
+    """Calculate expression from fastq files"""
+    _progress(sample_id, "expression")
+    methods["start"] = datetime.datetime.utcnow().isoformat()
+    with settings(warn_only=True):
+        if ercc:
+            result = run("cd /mnt && make expression_ercc")
+        else:
+            result = run("cd /mnt && make expression")
+        if result.failed:
+            _log_error("{} Failed expression: {}".format(sample_id, result))
+            return False
+
+    # Unpack outputs and normalize names so we don't have sample id in them
+    with cd("/mnt/outputs/expression"):
+        run("tar -xvf *.tar.gz --strip 1")
+        run("rm *.tar.gz")
+        run("mv *.sorted.bam sorted.bam")
+
+    # Temporarily move sorted.bam and Kallisto/fusion.txt to parent dir so we don't download it
+    # Still pretty hacky but prevents temporary exposure of sequence data to downstream dir
+    with cd("/mnt/outputs/expression"):
+        run("mv sorted.bam ..")
+        run("mv Kallisto/fusion.txt ..")
+
+    # Update methods.json and copy output back
+    if ercc:
+        dest = "{}/{}".format(output, EXPRESSION_ERCC_DIR)
+    else:
+        dest = "{}/{}".format(output, EXPRESSION_DIR)
+    local("mkdir -p {}".format(dest))
+    methods["inputs"] = fastqs
+    methods["outputs"] = [
+        os.path.relpath(p, base) for p in get("/mnt/outputs/expression/*", dest)]
+    methods["end"] = datetime.datetime.utcnow().isoformat()
+    methods["pipeline"] = EXPRESSION_PIPELINE
+    with open("{}/methods.json".format(dest), "w") as f:
+        f.write(json.dumps(methods, indent=4))
+
+    # Move sorted.bam back to the expression dir so that QC can find it;
+    # and Kallisto/fusion.txt for pizzly
+    with cd("/mnt/outputs/expression"):
+        run("mv ../sorted.bam .")
+        run("mv ../fusion.txt Kallisto")
+    return True
+
+
+def _qc(base, output, methods, sample_id, ercc=False):
+    """Calculate qc (bam-umend-qc or bam-mend-qc) from the expression sorted.bam"""
+    _progress(sample_id, "qc")
+    methods["start"] = datetime.datetime.utcnow().isoformat()
+    with settings(warn_only=True):
+        if ercc:
+            result = run("cd /mnt && make qc_ercc")
+        else:
+            result = run("cd /mnt && make qc")
+        if result.failed:
+            _log_error("{} Failed qc: {}".format(sample_id, result))
+            return False
+
+    # Store sortedByCoord.md.bam and .bai in primary/derived
+    # First, move it out of the way momentarily so it won't get
+    # downloaded into downstream
+    bamdest = "{}/primary/derived/{}".format(base, sample_id)
+    local("mkdir -p {}".format(bamdest))
+    with cd("/mnt/outputs/qc"):
+        run("mv sortedByCoord.md.bam* ..")
+
+    # Update methods.json and copy output back
+    if ercc:
+        dest = "{}/{}".format(output, QC_ERCC_DIR)
+        local("mkdir -p {}".format(dest))
+        methods["inputs"] = ["{}/{}/sorted.bam".format(
+            os.path.relpath(output, base), EXPRESSION_ERCC_DIR)]
+    else:
+        dest = "{}/{}".format(output, QC_DIR)
+        local("mkdir -p {}".format(dest))
+        methods["inputs"] = ["{}/{}/sorted.bam".format(
+            os.path.relpath(output, base), EXPRESSION_DIR)]
+
+    methods["outputs"] = [
+        os.path.relpath(p, base) for p in get("/mnt/outputs/qc/*", dest)]
+
+    # Download the bams to primary/derived. Move ERCC bams to sortedByCoord.md.ERCC.bam before
+    # downloading so that they don't clobber any pre-existing non-ERCC bams.
+    # Then put them back.
+    if ercc:
+        with cd("/mnt/outputs"):
+            run("mv -v sortedByCoord.md.bam sortedByCoord.md.ERCC.bam")
+            run("mv -v sortedByCoord.md.bam.bai sortedByCoord.md.ERCC.bam.bai")
+        methods["outputs"] += [
+            os.path.relpath(p, base) for p in _get_large("/mnt/outputs/sortedByCoord.md.ERCC.bam*", bamdest)]
+        with cd("/mnt/outputs"):
+            run("mv -v sortedByCoord.md.ERCC.bam sortedByCoord.md.bam")
+            run("mv -v sortedByCoord.md.ERCC.bam.bai sortedByCoord.md.bam.bai")
+    else:
+        methods["outputs"] += [
+            os.path.relpath(p, base) for p in _get_large("/mnt/outputs/sortedByCoord.md.bam*", bamdest)]
+
+    methods["end"] = datetime.datetime.utcnow().isoformat()
+    methods["pipeline"] = QC_ERCC_PIPELINE if ercc else QC_PIPELINE
+    with open("{}/methods.json".format(dest), "w") as f:
+        f.write(json.dumps(methods, indent=4))
+
+    # And move the QC bam back so it's available to the variant caller
+    with cd("/mnt/outputs/qc"):
+        run("mv ../sortedByCoord.md.bam* .")
+    return True
+
+
+def _variants(base, output, methods, sample_id, ercc=False):
+    """Calculate variants from the qc sortedByCoord.md.bam"""
+    _progress(sample_id, "variants")
+    methods["start"] = datetime.datetime.utcnow().isoformat()
+    with settings(warn_only=True):
+        result = run("cd /mnt && make variants")
+        if result.failed:
+            _log_error("{} Failed variants: {}".format(sample_id, result))
+            return False
+
+    bamdest = "{}/primary/derived/{}".format(base, sample_id)
+    # Update methods.json and copy output back
+    if ercc:
+        dest = "{}/ucsctreehouse-mini-var-call-ERCC-0.0.1-1976429".format(output)
+        methods["inputs"] = ["{}/sortedByCoord.md.ERCC.bam".format(bamdest)]
+    else:
+        dest = "{}/ucsctreehouse-mini-var-call-0.0.1-1976429".format(output)
+        methods["inputs"] = ["{}/sortedByCoord.md.bam".format(bamdest)]
+
+    local("mkdir -p {}".format(dest))
+    methods["outputs"] = [
+        os.path.relpath(p, base) for p in get("/mnt/outputs/variants/*", dest)]
+    methods["end"] = datetime.datetime.utcnow().isoformat()
+    methods["pipeline"] = {
+        "source": "https://github.com/UCSC-Treehouse/mini-var-call",
+        "docker": {
+            "url": "https://hub.docker.com/r/ucsctreehouse/mini-var-call",
+            "version": "0.0.1",
+            "hash": "sha256:197642937956ae73465ad2ef4b42501681ffc3ef07fecb703f58a3487eab37ff" # NOQA
+        }
+    }
+    with open("{}/methods.json".format(dest), "w") as f:
+        f.write(json.dumps(methods, indent=4))
+    return True
+
+
+"""
+Stages in the order process runs them. Stages whose inputs only exist on the machine pull in
+the stage producing them: qc needs the sorted.bam and pizzly the Kallisto output of expression,
+and variants needs the sortedByCoord.md.bam from qc, though that can instead be put from the
+copy qc archives in primary/derived.
+"""
+
+STAGES = ["checksums", "expression", "qc", "pizzly", "fusions", "jfkm", "variants"]
+ERCC_STAGES = ["checksums", "expression", "qc"]
+FASTQ_STAGES = ["checksums", "expression", "fusions", "jfkm"]
+MANIFEST_COLUMNS = ["sample_id", "stages", "ercc", "priority", "inputs"]
+
+
+def _run_stage(stage, base, output, methods, sample_id, fastqs, ercc=False):
+    """ Run one of STAGES on a sample that has been set up on the machine """
+    if stage == "checksums":
+        return _checksums(base, output, methods, sample_id, fastqs, ercc=ercc)
+    if stage == "expression":
+        return _expression(base, output, methods, sample_id, fastqs, ercc=ercc)
+    if stage == "qc":
+        return _qc(base, output, methods, sample_id, ercc=ercc)
+    if stage == "pizzly":
+        return _pizzly(base, output, methods, sample_id, ercc=ercc)
+    if stage == "fusions":
+        return _fusions(base, output, methods, sample_id, fastqs, ercc=ercc)
+    if stage == "jfkm":
+        return _jfkm(base, output, methods, sample_id, fastqs, ercc=ercc)
+    if stage == "variants":
+        return _variants(base, output, methods, sample_id, ercc=ercc)
+
+
+def _split_stages(stages):
+    return [stage.strip() for stage in re.split(r"[,+]", stages) if stage.strip()]
+
+
+def _read_manifest(manifest, stages="", ercc="False", columns=MANIFEST_COLUMNS,
+                   checksum_only="False"):
+    """ Samples listed in 'manifest' sorted by priority and then id
+
+        The manifest is either sample ids separated by commas or lines, or a tsv whose header
+        starts with sample_id followed by any of these optional columns:
+
+            stages    stages to run separated by commas, all of them if empty
+            ercc      True to run the ERCC-aware pipeline
+            priority  samples with higher numbers are processed first, default 0
+            inputs    fastqs or bam to use instead of searching primary, relative to base
+                      and separated by commas
+
+        'stages' and 'ercc' are used for samples that don't specify their own, while
+        'checksum_only' runs just checksums on every sample whatever its stages. Tasks that only
+        honour some of the columns pass them as 'columns' so a manifest using the others aborts
+        rather than being half applied. A sample on more than one row of a tsv is marked
+        'duplicate', while repeats in a plain list of ids are simply dropped.
+    """
+    with open(manifest) as f:
+        lines = [line.rstrip("\r\n") for line in f.readlines() if line.strip()]
+
+    defaults = {"stages": _split_stages(stages), "ercc": ercc == "True", "priority": 0,
+                "inputs": [], "duplicate": False}
+    if checksum_only == "True":
+        defaults["stages"] = ["checksums"]
+
+    if not lines or lines[0].split("\t")[0].strip() != "sample_id":
+        sample_ids = [word.strip() for line in lines for word in line.split(",") if word.strip()]
+        if len(set(sample_ids)) < len(sample_ids):
+            print("WARNING samples listed more than once in {} will be processed once".format(
+                manifest))
+        return [dict(defaults, sample_id=sample_id) for sample_id in sorted(set(sample_ids))]
+
+    header = [column.strip() for column in lines[0].split("\t")]
+    unknown = [column for column in header if column not in MANIFEST_COLUMNS]
+    if unknown:
+        abort("Unknown columns in {}: {}".format(manifest, ", ".join(unknown)))
+    unsupported = [column for column in header if column not in columns]
+    if unsupported:
+        abort("Columns in {} not supported by this task: {}".format(
+            manifest, ", ".join(unsupported)))
+
+    samples = []
+    for line in lines[1:]:
+        row = dict(zip(header, [value.strip() for value in line.split("\t")]))
+        sample = dict(defaults, sample_id=row["sample_id"])
+        if row.get("stages") and checksum_only != "True":
+            sample["stages"] = _split_stages(row["stages"])
+        if row.get("ercc"):
+            sample["ercc"] = row["ercc"].lower() in ("true", "yes", "1")
+        if row.get("priority"):
+            try:
+                sample["priority"] = int(row["priority"])
+            except ValueError:
+                abort("Invalid priority for {} in {}: {}".format(
+                    row["sample_id"], manifest, row["priority"]))
+        if row.get("inputs"):
+            sample["inputs"] = [path.strip() for path in row["inputs"].split(",")
+                                if path.strip()]
+        samples.append(sample)
+    return sorted(_mark_duplicates(samples),
+                  key=lambda sample: (-sample["priority"], sample["sample_id"]))
+
+
+def _mark_duplicates(samples):
+    """ Mark every row of a sample listed more than once, as which of them is meant is unclear """
+    counts = {}
+    for sample in samples:
+        counts[sample["sample_id"]] = counts.get(sample["sample_id"], 0) + 1
+    for sample in samples:
+        sample["duplicate"] = counts[sample["sample_id"]] > 1
+    return samples
+
+
+"""
+Intermediates archived in primary/derived can stand in for re-running the stages that made them.
+Currently that is the sortedByCoord.md.bam from qc which is all variants needs. It is only used if
+the methods.json of the qc and expression runs that made it match the dockers _expression and _qc
+use today and the inputs primary would give us, otherwise the sample starts again from the fastqs.
+"""
+
+
+def _checkpoint(sample_id, base, inputs=None):
+    """ Archived sortedByCoord.md.bam for a sample if it is valid to start variants from
+
+        Returns the path or None along with the reason it can't be used.
+    """
+    derived = "primary/derived/{}".format(sample_id)
+    bam = "{}/sortedByCoord.md.bam".format(derived)
+    for path in (bam, bam + ".bai"):
+        if not os.path.exists(os.path.join(base, path)) or \
+                not os.path.getsize(os.path.join(base, path)):
+            return None, "{} not found".format(path)
+
+    methods = {}
+    for name, pipeline in ((EXPRESSION_DIR, EXPRESSION_PIPELINE), (QC_DIR, QC_PIPELINE)):
+        path = "{}/downstream/{}/secondary/{}/methods.json".format(base, sample_id, name)
+        try:
+            with open(path) as f:
+                methods[name] = json.load(f)
+        except (IOError, ValueError):
+            return None, "no readable {}".format(os.path.relpath(path, base))
+        if methods[name].get("pipeline", {}).get("docker", {}).get("hash") != \
+                pipeline["docker"]["hash"]:
+            return None, "{} was made with a different docker".format(name)
+
+    qc = methods[QC_DIR]
+    if bam not in qc.get("outputs", []):
+        return None, "{} is not an output of the recorded qc".format(bam)
+    expression = methods[EXPRESSION_DIR]
+    if not qc.get("start") or not expression.get("end"):
+        return None, "qc or expression methods.json has no start or end time"
+    if qc["start"] < expression["end"]:
+        return None, "expression has been re-run since qc"
+
+    # If the reads are still in primary make sure they are the ones the bam was made from
+    kind, files = _primary_files(sample_id, base, inputs)
+    if kind and sorted(expression.get("inputs", [])) != \
+            sorted(os.path.relpath(f, base) for f in files):
+        return None, "primary inputs differ from those expression was run on"
+
+    return os.path.join(base, bam), None
+
+
+def _plan(sample, base):
+    """ Work out which stages to run for a sample and the minimal inputs to put for them
+
+        Returns a dict with the stages in run order, those added to produce intermediates,
+        whether fastqs are needed along with the primary 'files' and their 'bytes', the
+        archived 'bam' to put for variants if any, a list of 'notes' on why stages were
+        added and a list of 'errors'.
+    """
+    sample_id = sample["sample_id"]
+    requested = sample["stages"] or (ERCC_STAGES if sample["ercc"] else STAGES)
+    errors = []
+    if sample["duplicate"]:
+        errors.append("listed more than once in the manifest")
+    unknown = [stage for stage in requested if stage not in STAGES]
+    if unknown:
+        errors.append("unknown stages {}".format(", ".join(unknown)))
+    if sample["ercc"] and set(requested) - set(ERCC_STAGES):
+        errors.append("only {} can be run with ERCC".format(", ".join(ERCC_STAGES)))
+
+    stages = set(requested)
+    notes = []
+    bam = None
+    if "variants" in stages and "qc" not in stages:
+        bam, reason = _checkpoint(sample_id, base, sample["inputs"])
+        if not bam:
+            notes.append("archived bam not used as {}".format(reason))
+            stages.add("qc")
+    if stages & set(["qc", "pizzly"]):
+        stages.add("expression")
+
+    fastqs = bool(stages & set(FASTQ_STAGES))
+    files = [bam] if bam else []
+    if fastqs:
+        missing = [path for path in sample["inputs"]
+                   if not os.path.exists(os.path.join(base, path))]
+        kind, primary = _primary_files(sample_id, base, sample["inputs"])
+        if missing:
+            errors.append("inputs not found {}".format(", ".join(missing)))
+        elif not kind:
+            errors.append("unable to find fastqs or a bam in primary")
+        files += primary
+
+    return {"sample_id": sample_id,
+            "stages": [stage for stage in STAGES if stage in stages],
+            "added": [stage for stage in STAGES if stage in stages - set(requested)],
+            "fastqs": fastqs,
+            "inputs": sample["inputs"],
+            "files": files,
+            "bytes": sum(os.path.getsize(f) for f in files if os.path.exists(f)),
+            "bam": bam,
+            "notes": notes,
+            "errors": errors}
+
+
+@runs_once
+def plan(manifest="manifest.tsv", base=".", checksum_only="False", ercc="False", stages=""):
+    """ Show the stages and inputs process would use for each sample in 'manifest' """
+    samples = _read_manifest(manifest, stages, ercc, checksum_only=checksum_only)
+    machines = env.hostnames or ["-"]
+    total = 0
+    invalid = 0
+    for index, sample in enumerate(samples):
+        sample_plan = _plan(sample, base)
+        if sample_plan["errors"]:
+            invalid += 1
+            print("{} INVALID {}".format(sample["sample_id"], "; ".join(sample_plan["errors"])))
+            continue
+        total += sample_plan["bytes"]
+        print("{} on {} priority {}{}: {}{} from {} ({:.1f}G)".format(
+            sample["sample_id"], machines[index % len(machines)], sample["priority"],
+            " ERCC" if sample["ercc"] else "", ",".join(sample_plan["stages"]),
+            " (added {})".format("; ".join([",".join(sample_plan["added"])]
+                                           + sample_plan["notes"]))
+            if sample_plan["added"] else "",
+            ", ".join(os.path.relpath(f, base) for f in sample_plan["files"]),
+            sample_plan["bytes"] / 1024.0 ** 3))
+    print("{} samples, {} invalid, {:.1f}G to transfer".format(
+        len(samples), invalid, total / 1024.0 ** 3))
+
+
 @parallel
 def one_docker(manifest="manifest.tsv", base=".", checksum_only="False"):
     """
         Run a single docker step for all ids listed in 'manifest.'
         Doesn't do any setup or cleanup. This is for testing new dockers on existing output
     """
-    with open(manifest) as f:
-        sample_ids = sorted([word.strip() for line in f.readlines() for word in line.split(',')
-                             if word.strip()])[env.hosts.index(env.host)::len(env.hosts)]
+    samples = _read_manifest(manifest, columns=["sample_id", "priority"])[
+        env.hosts.index(env.host)::len(env.hosts)]
 
-    for sample_id in sample_ids:
+    for position, sample in enumerate(samples, 1):
+        sample_id = sample["sample_id"]
+        if sample["duplicate"]:
+            _log_error("{} Skipped as listed more than once in the manifest".format(sample_id))
+            continue
         print("{} Running one {}".format(env.host, sample_id))
+        _progress(sample_id, "setup", position=position, total=len(samples))
 
         # Intialize fake fastqs - this is only for printing to methods
         # The inner docker finds fastqs via the Makefile
@@ -452,7 +1392,10 @@ def one_docker(manifest="manifest.tsv", base=".", checksum_only="False"):
         local("mkdir -p {}".format(output))
 
         # Run your docker here
-        _jfkm(base, output, methods, sample_id, fastqs)
+        if _jfkm(base, output, methods, sample_id, fastqs):
+            _progress(sample_id, "finished")
+
+    _progress(None, "done")
 
 
 @parallel
@@ -462,26 +1405,35 @@ def fusion(manifest="manifest.tsv", base="."):
     # Copy Makefile in case we changed it while developing...
     put("{}/Makefile".format(os.path.dirname(env.real_fabfile)), "/mnt")
 
-    # Read ids and pick every #hosts to allocate round robin to each machine
-    with open(manifest) as f:
-        sample_ids = sorted([word.strip() for line in f.readlines() for word in line.split(',')
-                             if word.strip()])[env.hosts.index(env.host)::len(env.hosts)]
+    # Read samples and pick every #hosts to allocate round robin to each machine
+    samples = _read_manifest(manifest, columns=["sample_id", "priority", "inputs"])[
+        env.hosts.index(env.host)::len(env.hosts)]
 
-    for sample_id in sample_ids:
+    for position, sample in enumerate(samples, 1):
+        sample_id = sample["sample_id"]
+        _progress(sample_id, "setup", position=position, total=len(samples))
+
+        sample_plan = _plan(dict(sample, stages=["fusions"]), base)
+        if sample_plan["errors"]:
+            _log_error("{} Invalid plan: {}".format(sample_id, "; ".join(sample_plan["errors"])))
+            continue
 
         # Set up the sample fastqs and output dir
-        setup_ok, methods, fastqs, output = _setup(sample_id, base)
+        setup_ok, methods, fastqs, output = _setup(sample_id, base, sample_plan)
         if not setup_ok:
             continue
 
         # And run fusion only.
         if not _fusions(base, output, methods, sample_id, fastqs):
             continue
+        _progress(sample_id, "finished")
 
+    _progress(None, "done")
 
-def _setup(sample_id, base):
-    """ Preprocessing step for a single sample. Upload fastqs, setup methods dict,
-        create output dir.
+
+def _setup(sample_id, base, sample_plan=None):
+    """ Preprocessing step for a single sample. Upload the fastqs and/or archived bam the
+        sample_plan needs (fastqs if none), setup methods dict, create output dir.
         Returns success status, base methods dict, fastqs, output."""
     print("{} processing {}".format(env.host, sample_id))
 
@@ -490,15 +1442,25 @@ def _setup(sample_id, base):
 
     run("mkdir -p /mnt/samples")
 
-    # Put secondary input files from primary storage
-    fastqs = _put_primary(sample_id, base)
-    print("Original fastq paths", fastqs)
-    fastqs = [os.path.relpath(fastq, base) for fastq in fastqs]
-    print("Relative fastq paths", fastqs)
-
-    if not fastqs:
-        _log_error("Unable to find any fastqs or bams associated with {}".format(sample_id))
-        return (False, False, False, False)
+    if sample_plan and sample_plan["bam"]:
+        # Put the bam archived by a previous qc where the variants target looks for it. It is
+        # staged in /mnt/samples, which unlike /mnt/outputs keeps partial uploads across
+        # reset(), and put before the fastqs so their cleanup doesn't find it half done.
+        _put_samples([sample_plan["bam"]], keep=sample_plan["files"])
+        run("mkdir -p /mnt/outputs/qc && mv /mnt/samples/{} /mnt/outputs/qc/".format(
+            os.path.basename(sample_plan["bam"])))
+
+    fastqs = []
+    if sample_plan is None or sample_plan["fastqs"]:
+        # Put secondary input files from primary storage
+        fastqs = _put_primary(sample_id, base, sample_plan and sample_plan["inputs"])
+        print("Original fastq paths", fastqs)
+        fastqs = [os.path.relpath(fastq, base) for fastq in fastqs]
+        print("Relative fastq paths", fastqs)
+
+        if not fastqs:
+            _log_error("Unable to find any fastqs or bams associated with {}".format(sample_id))
+            return (False, False, False, False)
 
     # Create downstream output parent
     output = "{}/downstream/{}/secondary".format(base, sample_id)
@@ -514,244 +1476,57 @@ def _setup(sample_id, base):
     return (True, methods, fastqs, output)
 
 @parallel
-def process(manifest="manifest.tsv", base=".", checksum_only="False", ercc="False"):
-    """ Process all ids listed in 'manifest' """
+def process(manifest="manifest.tsv", base=".", checksum_only="False", ercc="False", stages=""):
+    """ Process all ids listed in 'manifest'
+
+        Runs the stages listed for each sample in a tsv manifest (see _read_manifest) or else
+        'stages' separated by + (e.g. stages=qc+variants), putting only the inputs they need.
+    """
 
     # Copy Makefile in case we changed it while developing...
     put("{}/Makefile".format(os.path.dirname(env.real_fabfile)), "/mnt")
 
-    # Read ids and pick every #hosts to allocate round robin to each machine
-    with open(manifest) as f:
-        sample_ids = sorted([word.strip() for line in f.readlines() for word in line.split(',')
-                             if word.strip()])[env.hosts.index(env.host)::len(env.hosts)]
-
-
-    # Set up ercc as a boolean for convenience!
-    if ercc == "True":
-        do_ercc = True
-    else:
-       do_ercc = False
+    # Read samples and pick every #hosts to allocate round robin to each machine
+    samples = _read_manifest(manifest, stages, ercc, checksum_only=checksum_only)[
+        env.hosts.index(env.host)::len(env.hosts)]
 
     # Will accumulate sample_id strings of samples
     # where the fusions step returned False
     fusion_failed_samples = []
 
-    for sample_id in sample_ids:
+    for position, sample in enumerate(samples, 1):
+        sample_id = sample["sample_id"]
+        _progress(sample_id, "setup", position=position, total=len(samples))
 
-        # Set up the sample fastqs and output dir
-        setup_ok, methods, fastqs, output = _setup(sample_id, base)
-        if not setup_ok:
+        sample_plan = _plan(sample, base)
+        if sample_plan["errors"]:
+            _log_error("{} Invalid plan: {}".format(sample_id, "; ".join(sample_plan["errors"])))
             continue
+        if sample_plan["added"]:
+            print("{} also running {} to produce intermediates{}".format(
+                sample_id, ", ".join(sample_plan["added"]),
+                "".join("; " + note for note in sample_plan["notes"])))
 
-        # Begin running pipelines
-
-        # Calculate checksums
-        methods["start"] = datetime.datetime.utcnow().isoformat()
-        with settings(warn_only=True):
-            result = run("cd /mnt && make checksums")
-            if result.failed:
-                _log_error("{} Failed checksums: {}".format(sample_id, result))
-                continue
-
-        # Update methods.json and copy output back
-        if do_ercc:
-            dest = "{}/md5sum-ERCC-3.7.0-ccba511".format(output)
-        else:
-            dest = "{}/md5sum-3.7.0-ccba511".format(output)
-        local("mkdir -p {}".format(dest))
-        methods["inputs"] = fastqs
-        methods["outputs"] = [
-            os.path.relpath(p, base) for p in get("/mnt/outputs/checksums/*", dest)]
-        methods["end"] = datetime.datetime.utcnow().isoformat()
-        methods["pipeline"] = {
-            "source": "https://github.com/gliderlabs/docker-alpine",
-            "docker": {
-                "url": "https://hub.docker.com/alpine",
-                "version": "3.7.0",
-                "hash": "sha256:ccba511b1d6b5f1d83825a94f9d5b05528db456d9cf14a1ea1db892c939cda64" # NOQA
-            }
-        }
-        with open("{}/methods.json".format(dest), "w") as f:
-            f.write(json.dumps(methods, indent=4))
-
-        if checksum_only == "True":
+        # Set up the sample inputs and output dir
+        setup_ok, methods, fastqs, output = _setup(sample_id, base, sample_plan)
+        if not setup_ok:
             continue
 
-        # Calculate expression
-        methods["start"] = datetime.datetime.utcnow().isoformat()
-        with settings(warn_only=True):
-            if do_ercc:
-                result = run("cd /mnt && make expression_ercc")
-            else:
-                result = run("cd /mnt && make expression")
-            if result.failed:
-                _log_error("{} Failed expression: {}".format(sample_id, result))
-                continue
-
-        # Unpack outputs and normalize names so we don't have sample id in them
-        with cd("/mnt/outputs/expression"):
-            run("tar -xvf *.tar.gz --strip 1")
-            run("rm *.tar.gz")
-            run("mv *.sorted.bam sorted.bam")
-
-        # Temporarily move sorted.bam and Kallisto/fusion.txt to parent dir so we don't download it
-        # Still pretty hacky but prevents temporary exposure of sequence data to downstream dir
-        with cd("/mnt/outputs/expression"):
-            run("mv sorted.bam ..")
-            run("mv Kallisto/fusion.txt ..")
-
-        # Update methods.json and copy output back
-        if do_ercc:
-            dest = "{}/ucsc_cgl-rnaseq-cgl-pipeline-ERCC-3.3.4-785eee9".format(output)
-        else:
-            dest = "{}/ucsc_cgl-rnaseq-cgl-pipeline-3.3.4-785eee9".format(output)
-        local("mkdir -p {}".format(dest))
-        methods["inputs"] = fastqs
-        methods["outputs"] = [
-            os.path.relpath(p, base) for p in get("/mnt/outputs/expression/*", dest)]
-        methods["end"] = datetime.datetime.utcnow().isoformat()
-        methods["pipeline"] = {
-            "source": "https://github.com/BD2KGenomics/toil-rnaseq",
-            "docker": {
-                "url": "https://quay.io/ucsc_cgl/rnaseq-cgl-pipeline",
-                "version": "3.3.4-1.12.3",
-                "hash": "sha256:785eee9f750ab91078d84d1ee779b6f74717eafc09e49da817af6b87619b0756" # NOQA
-            }
-        }
-        with open("{}/methods.json".format(dest), "w") as f:
-            f.write(json.dumps(methods, indent=4))
-
-        # Move sorted.bam back to the expression dir so that QC can find it;
-        # and Kallisto/fusion.txt for pizzly
-        with cd("/mnt/outputs/expression"):
-            run("mv ../sorted.bam .")
-            run("mv ../fusion.txt Kallisto")
-
-        # Calculate qc (bam-umend-qc or bam-mend-qc)
-        methods["start"] = datetime.datetime.utcnow().isoformat()
-        with settings(warn_only=True):
-            if do_ercc:
-                result = run("cd /mnt && make qc_ercc")
-            else:
-                result = run("cd /mnt && make qc")
-            if result.failed:
-                _log_error("{} Failed qc: {}".format(sample_id, result))
+        # Begin running pipelines, stopping this sample at the first failure other than fusions
+        for stage in sample_plan["stages"]:
+            if _run_stage(stage, base, output, methods, sample_id, fastqs, ercc=sample["ercc"]):
                 continue
-
-        # Store sortedByCoord.md.bam and .bai in primary/derived
-        # First, move it out of the way momentarily so it won't get
-        # downloaded into downstream
-        bamdest = "{}/primary/derived/{}".format(base, sample_id)
-        local("mkdir -p {}".format(bamdest))
-        with cd("/mnt/outputs/qc"):
-            run("mv sortedByCoord.md.bam* ..")
-
-        # Update methods.json and copy output back
-        if do_ercc:
-            dest = "{}/ucsctreehouse-bam-mend-qc-ERCC-v2.0.2-1c3c627".format(output)
-            local("mkdir -p {}".format(dest))
-            methods["inputs"] = ["{}/ucsc_cgl-rnaseq-cgl-pipeline-ERCC-3.3.4-785eee9/sorted.bam".format(
-                os.path.relpath(output, base))]
-        else:
-            dest = "{}/ucsctreehouse-bam-umend-qc-1.1.1-5f286d7".format(output)
-            local("mkdir -p {}".format(dest))
-            methods["inputs"] = ["{}/ucsc_cgl-rnaseq-cgl-pipeline-3.3.4-785eee9/sorted.bam".format(
-                    os.path.relpath(output, base))]
-
-        methods["outputs"] = [
-            os.path.relpath(p, base) for p in get("/mnt/outputs/qc/*", dest)]
-
-        # Download the bams to primary/derived. Move ERCC bams to sortedByCoord.md.ERCC.bam before
-        # downloading so that they don't clobber any pre-existing non-ERCC bams.
-        # Then put them back.
-        if do_ercc:
-            with cd("/mnt/outputs"):
-                run("mv -v sortedByCoord.md.bam sortedByCoord.md.ERCC.bam")
-                run("mv -v sortedByCoord.md.bam.bai sortedByCoord.md.ERCC.bam.bai")
-            methods["outputs"] += [
-                os.path.relpath(p, base) for p in get("/mnt/outputs/sortedByCoord.md.ERCC.bam*", bamdest)]
-            with cd("/mnt/outputs"):
-                run("mv -v sortedByCoord.md.ERCC.bam sortedByCoord.md.bam")
-                run("mv -v sortedByCoord.md.ERCC.bam.bai sortedByCoord.md.bam.bai")
-        else:
-            methods["outputs"] += [
-                os.path.relpath(p, base) for p in get("/mnt/outputs/sortedByCoord.md.bam*", bamdest)]
-
-        methods["end"] = datetime.datetime.utcnow().isoformat()
-        if do_ercc:
-            methods["pipeline"] = {
-                "source": "https://github.com/UCSC-Treehouse/mend_qc/releases/tag/v2.0.2",
-                "docker": {
-                    "url": "https://hub.docker.com/r/ucsctreehouse/bam-mend-qc/",
-                    "version": "v2.0.2",
-                    "hash": "sha256:1c3c62731eb7e6bbfcba4600807022e250a9ee5874477d115939a5d33f39e39f" # NOQA
-                }
-            }
-        else:
-            methods["pipeline"] = {
-                "source": "https://github.com/UCSC-Treehouse/bam-umend-qc",
-                "docker": {
-                    "url": "https://hub.docker.com/r/ucsctreehouse/bam-umend-qc",
-                    "version": "1.1.1",
-                    "hash": "sha256:5f286d72395fcc5085a96d463ae3511554acfa4951aef7d691bba2181596c31f" # NOQA
-                }
-            }
-        with open("{}/methods.json".format(dest), "w") as f:
-            f.write(json.dumps(methods, indent=4))
-
-        # And move the QC bam back so it's available to the variant caller
-        with cd("/mnt/outputs/qc"):
-            run("mv ../sortedByCoord.md.bam* .")
-
-        if do_ercc:
-            print("This is an ERCC run -- Skipping pizzly, fusions, jfkm, variants.")
+            if stage != "fusions":
+                break
+            fusion_failed_samples.append(sample_id)
         else:
-            # Calculate pizzly from Kallisto results
-            if not _pizzly(base, output, methods, sample_id, ercc=do_ercc):
-                continue
-
-            # Calculate fusion - continue the further steps even if it failed.
-            if not _fusions(base, output, methods, sample_id, fastqs, ercc=do_ercc):
-                fusion_failed_samples.append(sample_id)
-
-            # Calculate jfkm from fastq files
-            if not _jfkm(base, output, methods, sample_id, fastqs, ercc=do_ercc):
-                continue
-
-            # Calculate variants
-            methods["start"] = datetime.datetime.utcnow().isoformat()
-            with settings(warn_only=True):
-                result = run("cd /mnt && make variants")
-                if result.failed:
-                    _log_error("{} Failed variants: {}".format(sample_id, result))
-                    continue
-
-            # Update methods.json and copy output back
-            if do_ercc:
-                dest = "{}/ucsctreehouse-mini-var-call-ERCC-0.0.1-1976429".format(output)
-                methods["inputs"] = ["{}/sortedByCoord.md.ERCC.bam".format(bamdest)]
-            else:
-                dest = "{}/ucsctreehouse-mini-var-call-0.0.1-1976429".format(output)
-                methods["inputs"] = ["{}/sortedByCoord.md.bam".format(bamdest)]
-
-            local("mkdir -p {}".format(dest))
-            methods["outputs"] = [
-                os.path.relpath(p, base) for p in get("/mnt/outputs/variants/*", dest)]
-            methods["end"] = datetime.datetime.utcnow().isoformat()
-            methods["pipeline"] = {
-                "source": "https://github.com/UCSC-Treehouse/mini-var-call",
-                "docker": {
-                    "url": "https://hub.docker.com/r/ucsctreehouse/mini-var-call",
-                    "version": "0.0.1",
-                    "hash": "sha256:197642937956ae73465ad2ef4b42501681ffc3ef07fecb703f58a3487eab37ff" # NOQA
-                }
-            }
-            with open("{}/methods.json".format(dest), "w") as f:
-                f.write(json.dumps(methods, indent=4))
-
-        print("Finished processing {}".format(sample_id))
+            if sample["ercc"]:
+                print("This is an ERCC run -- Skipping pizzly, fusions, jfkm, variants.")
+            print("Finished processing {}".format(sample_id))
+            _progress(sample_id, "finished")
 
     ## Once all samples have been processed
+    _progress(None, "done")
     print("Completed all samples in queue for this worker!")
     for sid in fusion_failed_samples:
         print("ERROR: Sample {} did not generate fusion results.".format(sid))